@@ -1,7 +1,26 @@
 import pandas as pd
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import os
+import json
+import logging
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# number of concurrent requests; the session's connection pool matches it
+MAX_WORKERS = 32
+
+# client ids are lowercase hex uuids
+CLIENT_ID_RE = re.compile(r"[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}")
+
+logger = logging.getLogger(__name__)
+
+CAMPAIGN_URL = "https://api.flowcode.com/v2/flowcode/batch/bulk-campaign"
 
 
 def generate_flowcodes(client_id,
@@ -55,49 +74,55 @@ def generate_flowcodes(client_id,
     if not parent_dir:
         parent_dir = os.getcwd()
 
-    dataset = dataset.loc[:, [id_column_name, campaign_column_name]]
-    campaigns = dataset[campaign_column_name].unique()
-
-    # STEP ONE: GENERATING CAMPAIGNS
-    _generate_campaigns(campaigns=campaigns,
-                        client_id=client_id,
-                        id_column_name=id_column_name,
-                        campaign_column_name=campaign_column_name,
-                        dataset=dataset,
-                        reserved_urls=False)
-
-    # STEP TWO: PRE-PROCESSING URLS
-    flowcodes = _preprocess_urls(campaigns=campaigns,
-                                 id_column_name=id_column_name,
-                                 campaign_column_name=campaign_column_name,
-                                 redirect_url=redirect_url,
-                                 dataset=dataset,
-                                 pass_id_as_argument=pass_id_as_argument)
-
-    # STEP THREE: SENDING URL POST REQUESTS FOR EACH CAMPAIGN
-    responses = _generate_urls(flowcodes=flowcodes,
-                               campaigns=campaigns,
-                               client_id=client_id,
-                               smart_rules=smart_rules)
-
-    # STEP FOUR: ACCESSING QR CODE REQUESTS
-    generated_urls = _process_url_responses(responses)
-
-    # STEP FIVE: CREATING SVGS
-    _generate_svgs(parent_dir=parent_dir,
-                   generated_urls=generated_urls)
+    # copy just the columns we need, with ids stored as strings and
+    # campaigns as categories so grouping works on integer codes; a column
+    # that was already categorical can carry categories with no rows
+    dataset = (dataset.loc[:, [id_column_name, campaign_column_name]]
+               .copy()
+               .astype({id_column_name: "string",
+                        campaign_column_name: "category"}))
+    dataset[campaign_column_name] = dataset[campaign_column_name].cat.remove_unused_categories()
+    campaigns = dataset[campaign_column_name].cat.categories.to_numpy()
+
+    # one session for every request, so connections are kept alive and reused
+    with _create_session() as session:
+        # STEP ONE: GENERATING CAMPAIGNS
+        _generate_campaigns(session=session,
+                            campaigns=campaigns,
+                            client_id=client_id,
+                            id_column_name=id_column_name,
+                            campaign_column_name=campaign_column_name,
+                            dataset=dataset,
+                            reserved_urls=False,
+                            parent_dir=parent_dir)
+
+        # STEP TWO: PRE-PROCESSING URLS
+        flowcodes = _preprocess_urls(id_column_name=id_column_name,
+                                     campaign_column_name=campaign_column_name,
+                                     redirect_url=redirect_url,
+                                     dataset=dataset,
+                                     pass_id_as_argument=pass_id_as_argument)
+
+        # STEP THREE: SENDING URL POST REQUESTS FOR EACH CAMPAIGN
+        generated_urls = _generate_urls(session=session,
+                                        flowcodes=flowcodes,
+                                        client_id=client_id,
+                                        smart_rules=smart_rules)
+
+        # STEP FOUR: CREATING SVGS
+        _generate_svgs(session=session,
+                       parent_dir=parent_dir,
+                       generated_urls=generated_urls)
 
     return "Flowcodes Generated"
 
 
 def _error_checking(client_id, dataset, id_column_name, campaign_column_name):
     # checking client_id
-    regex = "[a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12}"
-
     if not isinstance(client_id, str):
         raise Exception(f"The client id must be a string, but is a: {type(client_id)}")
 
-    if not re.fullmatch(regex, client_id):
+    if not CLIENT_ID_RE.fullmatch(client_id):
         raise Exception("Your client id doesn't look like it's the right format"
                         "(aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa)")
 
@@ -114,144 +139,273 @@ def _error_checking(client_id, dataset, id_column_name, campaign_column_name):
         raise Exception("The campaigns column is not specified correctly. \n"
                         "Make sure it's a name, not an index!")
 
+    # every flowcode needs an id, both as its name and in its url
+    if dataset[id_column_name].isna().any():
+        raise Exception("The id column contains missing values. \n"
+                        "Make sure every row has an id!")
 
-def _generate_campaigns(campaigns, client_id, id_column_name, campaign_column_name,
-                        dataset, reserved_urls):
-    campaign_url = "https://api.flowcode.com/v2/flowcode/batch/bulk-campaign"
 
-    print("Creating Campaigns!")
-    for campaign in campaigns:
-        data = {
-            "name": f"{campaign}",
-            "display_name": f"{campaign} display",
-            "client_id": client_id,
-            "reserved_urls_unique": reserved_urls
-        }
+def _create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS,
+                          pool_maxsize=MAX_WORKERS,
+                          max_retries=Retry(total=3, backoff_factor=0.2))
+    session.mount("https://", adapter)
+    return session
+
+
+def _generate_campaigns(session, campaigns, client_id, id_column_name, campaign_column_name,
+                        dataset, reserved_urls, parent_dir):
+    # campaigns created on earlier runs are recorded in parent_dir, so we
+    # don't send requests for them again
+    cache_file = os.path.join(parent_dir, f"{client_id}_campaigns.json")
+    created = set()
+    if os.path.exists(cache_file):
         try:
-            response = requests.post(campaign_url, data)
-            response.raise_for_status()
-            print(response.text)
-        except requests.exceptions.HTTPError as err:
-            if err.response.status_code == 409:
-                print(f"Campaign {campaign} already exists! Skipping creation")
-            else:
-                raise err
+            with open(cache_file) as handler:
+                created = set(json.load(handler))
+        except ValueError:
+            # a damaged cache only costs us some repeated requests
+            logger.warning("Ignoring unreadable campaign cache %s", cache_file)
+    new_campaigns = [campaign for campaign in campaigns
+                     if str(campaign) not in created]
+    if not new_campaigns:
+        return campaigns
+
+    logger.debug("Creating %d campaigns", len(new_campaigns))
+    try:
+        # only trust campaigns the bulk response names; anything else is
+        # created one request at a time
+        created.update(_create_campaigns_in_bulk(session, client_id, reserved_urls,
+                                                 new_campaigns))
+        remaining = [campaign for campaign in new_campaigns
+                     if str(campaign) not in created]
+        if remaining:
+            # campaigns don't depend on each other, so send the requests
+            # concurrently
+            create = partial(_create_campaign, session, client_id, reserved_urls)
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                for campaign in executor.map(create, remaining):
+                    created.add(str(campaign))
+    finally:
+        # write to a temporary file first so an interrupted write can't
+        # leave a truncated cache behind
+        tmp_file = cache_file + ".tmp"
+        with open(tmp_file, 'w') as handler:
+            json.dump(sorted(created), handler)
+        os.replace(tmp_file, cache_file)
     return campaigns
 
 
-def _preprocess_urls(campaigns, id_column_name, campaign_column_name,
-                     redirect_url, dataset, pass_id_as_argument):
-    campaign_data = []
-    for campaign in campaigns:
-        # get all rows where the campaign id is equal to our active campaign
-        campaign_data.append(dataset.loc[dataset[campaign_column_name] == campaign])
-
-    flowcodes = []  # initialise an empty list to store our url data
-
-    for campaign in campaign_data:
-        campaign_list = []
-        for index, row in campaign.iterrows():
-            if pass_id_as_argument:
-                id_string = f"{id_column_name}"
-                url_string = "".join([redirect_url, f"/id={row[id_string]}"])
-            else:
-                url_string = redirect_url
-            campaign_list.append(
-                              {
-                                  "id": f"{row[id_string]}",
-                                  "url_type": "URL",
-                                  "url": url_string,
-                              })
-        flowcodes.append(campaign_list)
-    return flowcodes
+def _create_campaigns_in_bulk(session, client_id, reserved_urls, campaigns):
+    # try to create every campaign in a single request; returns the names of
+    # the campaigns the response confirms were created, which is empty if the
+    # api won't take them together (e.g. some already exist)
+    names = {str(campaign) for campaign in campaigns}
+    data = {
+        "client_id": client_id,
+        "campaigns": [
+            {
+                "name": str(campaign),
+                "display_name": f"{campaign} display",
+                "reserved_urls_unique": reserved_urls
+            }
+            for campaign in campaigns
+        ]
+    }
+    try:
+        with session.post(CAMPAIGN_URL, json=data) as response:
+            response.raise_for_status()
+            # only decode the body when it will actually be logged
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Created campaigns: %s", response.text)
+            body = response.json()
+    except requests.exceptions.HTTPError as err:
+        # unsupported payload, or some of the campaigns already exist;
+        # anything else (auth, rate limiting) should stop the run
+        if err.response.status_code in (400, 409, 422):
+            return set()
+        raise err
+    except ValueError:  # the response wasn't json, so confirms nothing
+        return set()
+
+    if isinstance(body, dict):
+        body = body.get("campaigns", [])
+    if not isinstance(body, list):
+        return set()
+    return {campaign["name"] for campaign in body
+            if isinstance(campaign, dict) and campaign.get("name") in names}
+
+
+def _create_campaign(session, client_id, reserved_urls, campaign):
+    data = {
+        "name": str(campaign),
+        "display_name": f"{campaign} display",
+        "client_id": client_id,
+        "reserved_urls_unique": reserved_urls
+    }
+    try:
+        response = session.post(CAMPAIGN_URL, json=data)
+        response.raise_for_status()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Created campaign %s: %s", campaign, response.text)
+    except requests.exceptions.HTTPError as err:
+        if err.response.status_code == 409:
+            logger.info("Campaign %s already exists! Skipping creation", campaign)
+        else:
+            raise err
+    return campaign
 
 
-def _generate_urls(flowcodes, campaigns, client_id, smart_rules):
-    codes_url = "https://api.flowcode.com/v2/flowcode/batch/bulk"
-    responses = {}  # create a dictionary for storing campaigns and responses
+def _preprocess_urls(id_column_name, campaign_column_name, redirect_url,
+                     dataset, pass_id_as_argument):
+    # split the dataset into campaigns in a single pass
+    campaign_data = dict(list(dataset.groupby(campaign_column_name,
+                                              observed=True)))
+
+    flowcodes = {}  # initialise a dictionary to store each campaign's url data
+    id_prefix = f"{redirect_url}/id="
 
-    # send a request for each campaign in "flowcodes"
-    for index, value in enumerate(flowcodes):
-        if not value:  # deals with errors caused by empty campaigns
-            pass
+    for campaign, campaign_rows in campaign_data.items():
+        ids = campaign_rows[id_column_name]
+        if pass_id_as_argument:
+            urls = (id_prefix + ids).tolist()
         else:
-            if smart_rules:
-                codes_data = {
-                        "client_id":  client_id,
-                        "campaign_name": f"{campaigns[index]}",
-                        "urls": flowcodes[index],
-                        "smart_rules": smart_rules
-                }
-            else:
-                codes_data = {
-                        "client_id":  client_id,
-                        "campaign_name": f"{campaigns[index]}",
-                        "urls": flowcodes[index],
-                }
-
-            # send the data as a json to support the formatting of "urls"
-            try:
-                flowcode_response = requests.post(codes_url, json=codes_data)
-                flowcode_response.raise_for_status()
-                responses[f'{campaigns[index]}'] = flowcode_response
-            except requests.exceptions.HTTPError as err:
-                if err.response.status_code == 409:
-                    print(f"Some URLS in Campaign {campaigns[index]} already exist!"
-                          "Skipping creation")
-                else:
-                    raise err
-    return responses
-
-
-def _process_url_responses(responses):
-    print(responses)
-    readable_responses = {campaign: response.json() for campaign, response in responses.items()}
+            urls = [redirect_url] * len(ids)
+        # build the records straight from plain lists; this is much cheaper
+        # than constructing a DataFrame just to call to_dict on it
+        campaign_list = [{"id": row_id, "url_type": "URL", "url": url}
+                         for row_id, url in zip(ids.tolist(), urls)]
+        flowcodes[campaign] = campaign_list
+    return flowcodes
+
+
+def _generate_urls(session, flowcodes, client_id, smart_rules):
+    # send a request for each campaign in "flowcodes", all at once
+    send = partial(_send_urls, session, client_id, smart_rules)
+    campaigns = list(flowcodes)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(send, campaigns, flowcodes.values()))
 
     # creates a dicionary called generated_urls, with campaigns as keys and
     # a list of ids and qr code urls as values.
-    generated_urls = {}
-    for campaign, urls in readable_responses.items():
-        generated_urls[f'{campaign}'] = []
-        for url in urls:
-            generated_urls[f'{campaign}'].append({"id": url['id'], "qr_code": url['images'][0]['url']})
+    generated_urls = {str(campaign): urls
+                      for campaign, urls in zip(campaigns, results)
+                      if urls is not None}
     return generated_urls
 
 
-def _generate_svgs(parent_dir, generated_urls):
-    # create a new directory to store images
-    root_dir = parent_dir + '/flowcode_images'
-    if not os.path.exists(root_dir):
-        os.mkdir(root_dir)
+def _send_urls(session, client_id, smart_rules, campaign, urls):
+    codes_url = "https://api.flowcode.com/v2/flowcode/batch/bulk"
 
-    for campaign, urls in generated_urls.items():
-        campaign_dir = root_dir + f'/{campaign}'
-        os.mkdir(campaign_dir)
+    if not urls:  # deals with errors caused by empty campaigns
+        return None
 
-        for url_object in urls:
-            id = url_object['id']
-            r = requests.get(url_object['qr_code'], allow_redirects=True)
-            file_url = "".join([campaign_dir, f"/{id}.svg"])
-            with open(file_url, 'wb') as handler:
-                handler.write(r.content)
+    if smart_rules:
+        codes_data = {
+                "client_id":  client_id,
+                "campaign_name": str(campaign),
+                "urls": urls,
+                "smart_rules": smart_rules
+        }
+    else:
+        codes_data = {
+                "client_id":  client_id,
+                "campaign_name": str(campaign),
+                "urls": urls,
+        }
+
+    # send the data as a json to support the formatting of "urls"; orjson
+    # encodes large url lists much faster than the standard json module, and
+    # OPT_NON_STR_KEYS keeps its handling of smart_rules keys like json's
+    try:
+        with session.post(codes_url,
+                          data=orjson.dumps(codes_data, option=orjson.OPT_NON_STR_KEYS),
+                          headers={"Content-Type": "application/json"}) as flowcode_response:
+            flowcode_response.raise_for_status()
+            # keep only the ids and qr code urls rather than the whole response
+            return [{"id": url['id'], "qr_code": url['images'][0]['url']}
+                    for url in flowcode_response.json()]
+    except requests.exceptions.HTTPError as err:
+        if err.response.status_code == 409:
+            logger.info("Some URLS in Campaign %s already exist! "
+                        "Skipping creation", campaign)
+        else:
+            raise err
+
+
+def _generate_svgs(session, parent_dir, generated_urls):
+    # create a new directory to store images, with one folder per campaign,
+    # before any downloads start
+    root_dir = os.path.join(parent_dir, 'flowcode_images')
+    os.makedirs(root_dir, exist_ok=True)
+    campaign_dirs = {campaign: os.path.join(root_dir, campaign)
+                     for campaign in generated_urls}
+    for campaign_dir in campaign_dirs.values():
+        os.makedirs(campaign_dir, exist_ok=True)
+
+    # downloads are independent, so fetch them all concurrently
+    download_dirs = [campaign_dirs[campaign]
+                     for campaign, urls in generated_urls.items()
+                     for url_object in urls]
+    url_objects = [url_object
+                   for urls in generated_urls.values()
+                   for url_object in urls]
+    download = partial(_download_svg, session)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(download, download_dirs, url_objects))
+
+
+def _download_svg(session, campaign_dir, url_object):
+    id = url_object['id']
+    file_url = os.path.join(campaign_dir, f"{id}.svg")
+    # skip images already saved by an earlier run
+    if os.path.exists(file_url) and os.path.getsize(file_url) > 0:
+        return
+
+    # stream the body straight to disk rather than buffering it in memory;
+    # writing to a temporary file means an interrupted download never
+    # leaves a partial svg that would be skipped next time. the name is
+    # unique per worker thread, so downloads of a repeated id don't collide
+    part_url = f"{file_url}.{threading.get_ident()}.part"
+    try:
+        with session.get(url_object['qr_code'], allow_redirects=True, stream=True) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            with open(part_url, 'wb') as handler:
+                shutil.copyfileobj(r.raw, handler, length=64 * 1024)
+        os.replace(part_url, file_url)
+    except Exception:
+        if os.path.exists(part_url):
+            os.remove(part_url)
+        raise
 
 ## TESTING THE FUNCTION
 
 
-ad_data = pd.read_csv("/Users/finnmacken/Desktop/Flowcode/api-ads/ads.csv")
-ad_data = ad_data.sample(n=5, random_state=5)
+if __name__ == "__main__":
+    # show the "already exists" messages when running the script directly
+    logging.basicConfig(level=logging.INFO)
+
+    # only read the two columns generate_flowcodes uses
+    ad_data = pd.read_csv("/Users/finnmacken/Desktop/Flowcode/api-ads/ads.csv",
+                          engine="pyarrow",
+                          usecols=["ad_id", "xyz_campaign_id"],
+                          dtype_backend="pyarrow")
+    ad_data = ad_data.sample(n=5, random_state=5)
 
-# ad_data
+    # ad_data
 
-# ad_data['xyz_campaign_id'].unique()
+    # ad_data['xyz_campaign_id'].unique()
 
 
-# ad_data.loc[ad_data['xyz_campaign_id'] == 936]
+    # ad_data.loc[ad_data['xyz_campaign_id'] == 936]
 
-# _preprocess_urls(campaigns, id_column_name, campaign_column_name, redirect_url, dataset, pass_id_as_argument)
+    # _preprocess_urls(id_column_name, campaign_column_name, redirect_url, dataset, pass_id_as_argument)
 
-generate_flowcodes(client_id="d929d46a-7eba-11ec-90d6-0242ac120003",
-                   id_column_name='ad_id',
-                   campaign_column_name="xyz_campaign_id",
-                   redirect_url="http://www.flowcode.com",
-                   dataset=ad_data,
-                   parent_dir="/Users/finnmacken/Desktop/Flowcode/api-ads")
+    generate_flowcodes(client_id="d929d46a-7eba-11ec-90d6-0242ac120003",
+                       id_column_name='ad_id',
+                       campaign_column_name="xyz_campaign_id",
+                       redirect_url="http://www.flowcode.com",
+                       dataset=ad_data,
+                       parent_dir="/Users/finnmacken/Desktop/Flowcode/api-ads")